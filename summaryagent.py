@@ -1,97 +1,586 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import tiktoken
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
-from typing import Callable
+from collections import OrderedDict, deque
+from functools import cache
+from itertools import islice
+from typing import Awaitable, Callable
 
 from langchain.agents.middleware import wrap_model_call, ModelRequest, ModelResponse, SummarizationMiddleware
 from langchain.agents import create_agent
 from langchain.messages import HumanMessage, SystemMessage, AIMessage
+from langchain_core.messages import message_to_dict, messages_from_dict
 from langchain_openai import ChatOpenAI
+from langgraph.config import get_config
 
 # Load environment variables (like API keys) from .env file
 load_dotenv()
 
-# How many recent messages to keep before we start summarizing old ones
-# If we have more than 3 messages, we'll summarize the old ones
+# How many recent messages we always keep as-is, even when summarizing
 SUMMARY_THRESHOLD = 3
 
-# Create a separate AI model just for summarizing conversations
-# We use a cheaper model (gpt-4o-mini) since summarization doesn't need the best model
-summarizer = ChatOpenAI(model="gpt-4o-mini", temperature=0.5)
+# Token budget for the message window (gpt-4o-mini has 128k context, we keep a 10% safety margin)
+# Once the window goes over this we summarize old messages until it's back under half of it
+# While the window only grows, last turn's messages stay an exact prefix of this turn's,
+# so OpenAI can reuse its prompt cache instead of re-reading the whole history
+MAX_CONTEXT_TOKENS = 115_200
+
+# Number of oldest messages grouped together in one chunk
+# All chunks go to the summarizer in a single call, separated by CHUNK_MARKER lines,
+# and the prompt asks it to cover every chunk, so no part of a long stretch gets skipped
+CHUNK_SIZE = 4
+CHUNK_MARKER = "---CHUNK---"
+CHUNK_SEPARATOR = f"\n{CHUNK_MARKER}\n"
+
+# Don't bother calling the summarizer for fewer messages than this, unless they free up
+# at least MIN_TOKENS_SAVED tokens (one huge message is worth summarizing on its own)
+# Summarizing one or two short messages costs a round-trip and saves almost nothing
+MIN_TO_SUMMARIZE = 3
+MIN_TOKENS_SAVED = 500
+
+# Cheap local clean-up before the summarizer sees the messages:
+# messages shorter than this ("ok", "thanks") are dropped,
+# and a message sharing more than this fraction of words with the message kept right before it is skipped,
+# if both came from the same sender
+MIN_MESSAGE_LENGTH = 8
+DUPLICATE_OVERLAP = 0.9
+
+# Most raw messages the window may hold, however short they are
+# Past this, the oldest get folded into the summary (down to half) even if the window is under its token budget,
+# so the CLI, which only keeps messages from the start of the window, stays bounded in memory
+BUFFER_MAX = 200
+
+# Most conversation windows kept in memory at once
+# The least recently used ones are dropped and reloaded from HISTORY_DB when they come back
+MAX_CACHED_WINDOWS = 100
+
+# SQLite file where conversation history and rolling summaries are saved between runs
+HISTORY_DB = os.getenv("SUMMARY_AGENT_DB", "summaryagent.db")
+
+# Fixed wording of the summarizer prompts, built once instead of formatting a new string every call
+_CHUNK_INSTRUCTIONS = f"The conversation is split into chunks of a few messages, separated by {CHUNK_MARKER} lines."
+_SUMMARY_PROMPT_PREFIX = (
+    f"Summarize this conversation briefly in 1-2 sentences. {_CHUNK_INSTRUCTIONS} "
+    "Cover the important points of every chunk:\n"
+)
+_ROLLING_PROMPT_PREFIX = "Prior summary: "
+_ROLLING_PROMPT_MIDDLE = f"\n\n{_CHUNK_INSTRUCTIONS}\nNew exchange:\n"
+_ROLLING_PROMPT_SUFFIX = (
+    "\n\nProduce an updated 1-2 sentence summary that keeps the key facts of the prior summary "
+    "and covers the important points of every chunk."
+)
+
+# Tokenizer used to measure how big the messages really are
+# Loading it is slow (it builds the whole BPE table), so we do it once here and reuse it
+_ENC = tiktoken.encoding_for_model("gpt-4o-mini")
+
+# Tokens taken up by the fixed wording of each summarizer prompt and by one chunk separator,
+# counted once here for budget math
+_SUMMARY_PROMPT_TOKENS = len(_ENC.encode(_SUMMARY_PROMPT_PREFIX))
+_ROLLING_PROMPT_TOKENS = len(_ENC.encode(_ROLLING_PROMPT_PREFIX + _ROLLING_PROMPT_MIDDLE + _ROLLING_PROMPT_SUFFIX))
+_SEPARATOR_TOKENS = len(_ENC.encode(CHUNK_SEPARATOR))
+
+
+@cache
+def get_summarizer() -> ChatOpenAI:
+    """
+    Create a separate AI model just for summarizing conversations.
+    We use a cheaper model (gpt-4o-mini) since summarization doesn't need the best model.
+    It's built on first use and shared afterwards, so importing this module opens no HTTP clients.
+    """
+    return ChatOpenAI(model="gpt-4o-mini", temperature=0.5)
+
+
+# Summaries we've already produced, keyed by the hash of their input (oldest first)
+# A growing conversation never repeats an input, since the prior summary changes every reset
+# It pays off when a conversation is replayed: a client that regenerates or edits its last turn
+# sends fewer messages, which resets the window, and every summary along the replayed prefix is a hit
+# functools.lru_cache can't cache coroutines, so we keep a small LRU of our own
+SUMMARY_CACHE_SIZE = 256
+_summary_cache: OrderedDict[str, str] = OrderedDict()
+
+
+def _build_prompt(chunk_text: str, prior_summary: str = "") -> str:
+    """Build the exact prompt sent to the summarizer for this text (and prior summary, if any)."""
+    # Glue the fixed wording and the text together in one go (chunk_text can be large)
+    if prior_summary:
+        return "".join((
+            _ROLLING_PROMPT_PREFIX, prior_summary,
+            _ROLLING_PROMPT_MIDDLE, chunk_text,
+            _ROLLING_PROMPT_SUFFIX,
+        ))
+    return _SUMMARY_PROMPT_PREFIX + chunk_text
+
+
+async def _summarize_chunk(chunk_hash: str, chunk_text: str, prior_summary: str = "") -> str:
+    """
+    Summarize a chunk of conversation text, remembering the result by its content hash.
+    When a prior summary is given, the summarizer folds the new text into it instead of starting over.
+    """
+    if chunk_hash in _summary_cache:
+        _summary_cache.move_to_end(chunk_hash)
+        return _summary_cache[chunk_hash]
+
+    # Await the summarizer so other conversations can keep going while we wait
+    prompt = _build_prompt(chunk_text, prior_summary)
+    summary_response = await get_summarizer().ainvoke([HumanMessage(content=prompt)])
+
+    _summary_cache[chunk_hash] = summary_response.content
+    if len(_summary_cache) > SUMMARY_CACHE_SIZE:
+        _summary_cache.popitem(last=False)
+    return summary_response.content
+
+
+async def _summarize(chunk_text: str, prior_summary: str = "", text_tokens: int | None = None) -> str:
+    """
+    Hash the text (and prior summary) and summarize it through the cache.
+    text_tokens is an upper bound on the text's token count, built from counts we already have.
+    Text that wouldn't fit in one summarizer prompt is cut short, so even an oversized message gets summarized.
+    """
+    # Room left for the text once the prompt wording and prior summary are counted
+    if prior_summary:
+        room = MAX_CONTEXT_TOKENS - _ROLLING_PROMPT_TOKENS - _count(prior_summary)
+    else:
+        room = MAX_CONTEXT_TOKENS - _SUMMARY_PROMPT_TOKENS
+
+    # Only tokenize the text itself when the cheap bound says it might not fit
+    # That can be tens of thousands of tokens, so it runs in a worker thread to keep the event loop free
+    if text_tokens is None or text_tokens > room:
+        chunk_text = await asyncio.to_thread(_truncate, chunk_text, room)
+
+    # Length-prefix the prior summary so different prior/text splits can't share a key
+    chunk_hash = hashlib.blake2b(f"{len(prior_summary)}:{prior_summary}{chunk_text}".encode(), digest_size=16).hexdigest()
+    return await _summarize_chunk(chunk_hash, chunk_text, prior_summary)
+
+
+def _count(text: str) -> int:
+    """Count how many tokens a piece of text takes up."""
+    return len(_ENC.encode(text))
+
+
+def _truncate(text: str, max_tokens: int) -> str:
+    """Cut text down to at most max_tokens tokens (unchanged if it already fits)."""
+    tokens = _ENC.encode(text)
+    return _ENC.decode(tokens[:max_tokens]) if len(tokens) > max_tokens else text
+
+
+def _message_hash(m) -> str:
+    """Fingerprint a message by its sender and text, to tell conversations apart."""
+    return hashlib.blake2b(f"{m.type}\n{m.text}".encode(), digest_size=16).hexdigest()
+
+
+def _prefilter(contents, message_types) -> list[str]:
+    """
+    Drop filler and near-duplicate messages before they're sent to the summarizer.
+    A message is a near-duplicate when it has the same type as the message kept right before it
+    and their word overlap (Jaccard) is above DUPLICATE_OVERLAP. Only that one previous message is checked.
+    """
+    kept = []
+    last_type, last_words = None, set()
+    for text, message_type in zip(contents, message_types):
+        # Short acknowledgements carry nothing worth summarizing
+        if len(text) < MIN_MESSAGE_LENGTH:
+            continue
+
+        # Skip a message that mostly repeats the previous kept one, if that came from the same sender
+        words = set(text.lower().split())
+        if message_type == last_type and len(words & last_words) > DUPLICATE_OVERLAP * len(words | last_words):
+            continue
+
+        kept.append(text)
+        last_type, last_words = message_type, words
+    return kept
+
+
+@dataclass
+class WindowState:
+    """Tracks where the message window starts for one session and the summary of everything before it."""
+
+    # Index of the first message we still send to the agent as-is
+    # Everything before it has already been folded into rolling_summary
+    window_start_idx: int = 0
+    # Running summary of every message that has left the window so far
+    rolling_summary: str = ""
+    # Fingerprint of the message at window_start_idx ("" until we've seen it)
+    # If a later call has a different message there, it's a different conversation
+    anchor_hash: str = ""
+    # The summary message we built last time, reused word-for-word until the next reset
+    summary_cache: SystemMessage | None = None
+    # Text and token count of every message in the window, in the same order as the messages
+    # Filled in once per message, so we never re-read or re-count old messages on later turns
+    message_contents: list[str] = field(default_factory=list)
+    message_tokens: list[int] = field(default_factory=list)
+    # Who sent each message ("human", "ai", ...), used to spot repeated messages
+    message_types: list[str] = field(default_factory=list)
+
+    def remember_new_messages(self, msgs, history_offset: int = 0) -> None:
+        """
+        Add the text and token count of any messages we haven't seen yet.
+        history_offset is how many older messages were left out of msgs.
+        """
+        # Last resort: if messages we never saw are missing from both msgs and the saved history,
+        # we have no text to summarize them with, so the window has to start after them
+        if history_offset > self.window_start_idx + len(self.message_contents):
+            self.window_start_idx = history_offset
+            self.message_contents.clear()
+            self.message_tokens.clear()
+            self.message_types.clear()
+
+        for m in msgs[max(0, self.window_start_idx + len(self.message_contents) - history_offset):]:
+            # .text is always a plain string, even when .content is a list of content blocks
+            text = m.text
+            tokens = _count(text)
+
+            # Only add to the lists once counting worked, so they always stay in step
+            self.message_contents.append(text)
+            self.message_tokens.append(tokens)
+            self.message_types.append(m.type)
+
+
+# One window per conversation, keyed by the session (thread) id
+# Least recently used first, capped at MAX_CACHED_WINDOWS
+_windows: OrderedDict[str, WindowState] = OrderedDict()
+
+# Held while a session's window is being updated
+# Kept apart from WindowState so resetting a window doesn't swap the lock out from under a waiting caller
+# Each entry also counts the callers holding or waiting for the lock, so it can be dropped once that hits zero
+_window_locks: dict[str, tuple[asyncio.Lock, int]] = {}
+
+
+@asynccontextmanager
+async def _session_lock(session_id: str):
+    """Hold a session's lock, and forget the lock once nobody is using it anymore."""
+    lock, users = _window_locks.get(session_id, (None, 0))
+    if lock is None:
+        lock = asyncio.Lock()
+    _window_locks[session_id] = (lock, users + 1)
+    try:
+        async with lock:
+            yield
+    finally:
+        lock, users = _window_locks[session_id]
+        if users == 1:
+            del _window_locks[session_id]
+        else:
+            _window_locks[session_id] = (lock, users - 1)
+
+# Connection to the history database, opened the first time we need it
+# The middleware uses it from worker threads (so the event loop isn't blocked), one thread at a time
+_db_connection: sqlite3.Connection | None = None
+_db_lock = threading.Lock()
+
+
+def _db() -> sqlite3.Connection:
+    """Open the history database (creating its tables if needed) and reuse the connection."""
+    global _db_connection
+    if _db_connection is None:
+        _db_connection = sqlite3.connect(HISTORY_DB, check_same_thread=False)
+        _db_connection.executescript("""
+            CREATE TABLE IF NOT EXISTS messages (
+                session_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                message TEXT NOT NULL,
+                PRIMARY KEY (session_id, idx)
+            );
+            CREATE TABLE IF NOT EXISTS summaries (
+                session_id TEXT PRIMARY KEY,
+                window_start_idx INTEGER NOT NULL,
+                rolling_summary TEXT NOT NULL,
+                anchor_hash TEXT NOT NULL DEFAULT ''
+            );
+        """)
+    return _db_connection
+
+
+def save_message(session_id: str, idx: int, message) -> None:
+    """Append one message to the saved history of a session."""
+    with _db_lock, _db() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO messages (session_id, idx, message) VALUES (?, ?, ?)",
+            (session_id, idx, json.dumps(message_to_dict(message))),
+        )
+
+
+def load_messages(session_id: str, start_idx: int = 0, end_idx: int | None = None) -> list:
+    """Load the saved messages of a session, from start_idx up to (not including) end_idx."""
+    with _db_lock:
+        rows = _db().execute(
+            "SELECT message FROM messages WHERE session_id = ? AND idx >= ? AND (? IS NULL OR idx < ?) ORDER BY idx",
+            (session_id, start_idx, end_idx, end_idx),
+        ).fetchall()
+    return messages_from_dict([json.loads(row[0]) for row in rows])
+
+
+def _save_window(session_id: str, state: WindowState) -> None:
+    """Save where the window starts and the rolling summary, so a restart doesn't re-summarize."""
+    with _db_lock, _db() as db:
+        db.execute(
+            "INSERT OR REPLACE INTO summaries (session_id, window_start_idx, rolling_summary, anchor_hash)"
+            " VALUES (?, ?, ?, ?)",
+            (session_id, state.window_start_idx, state.rolling_summary, state.anchor_hash),
+        )
+
+
+def _cache_window(session_id: str, state: WindowState) -> WindowState:
+    """Keep a session's window in memory, dropping the least recently used ones past MAX_CACHED_WINDOWS."""
+    _windows[session_id] = state
+    _windows.move_to_end(session_id)
+    while len(_windows) > MAX_CACHED_WINDOWS:
+        # Its summary and window start are already in HISTORY_DB; the per-message text is rebuilt from the next request
+        _windows.popitem(last=False)
+    return state
+
+
+def _load_window(session_id: str) -> WindowState:
+    """Build a session's window from its saved summary (or an empty one if nothing was saved)."""
+    state = WindowState()
+    with _db_lock:
+        row = _db().execute(
+            "SELECT window_start_idx, rolling_summary, anchor_hash FROM summaries WHERE session_id = ?",
+            (session_id,),
+        ).fetchone()
+    if row is not None:
+        state.window_start_idx, state.rolling_summary, state.anchor_hash = row
+        if state.rolling_summary:
+            state.summary_cache = SystemMessage(content=f"[Summary] {state.rolling_summary}")
+    return state
+
+
+def get_window(session_id: str) -> WindowState:
+    """Return the window for a session, loading the saved summary if it isn't in memory."""
+    if session_id in _windows:
+        _windows.move_to_end(session_id)
+        return _windows[session_id]
+    return _cache_window(session_id, _load_window(session_id))
+
+
+async def _aget_window(session_id: str) -> WindowState:
+    """Like get_window, but reads the database in a worker thread so the event loop keeps running."""
+    if session_id in _windows:
+        _windows.move_to_end(session_id)
+        return _windows[session_id]
+    return _cache_window(session_id, await asyncio.to_thread(_load_window, session_id))
+
+
+async def _advance_window(session_id: str, msgs, history_offset: int = 0) -> WindowState:
+    """
+    Bring a session's window up to date with msgs, summarizing old messages if it went over budget.
+    Used by the middleware, and by the CLI in the background between turns.
+    """
+    # Only one update per session at a time, so a background update and a model call don't race
+    async with _session_lock(session_id):
+        # Look up (or load, or start) the window for this conversation
+        # Done after taking the lock, so we always see what the previous update left behind
+        state = await _aget_window(session_id)
+
+        # Fewer messages than before means a brand new conversation on the same session,
+        # and so does a different message where our window starts
+        anchor_idx = state.window_start_idx - history_offset
+        is_new_conversation = False
+        if history_offset + len(msgs) < state.window_start_idx + len(state.message_contents) or (
+            state.anchor_hash
+            and 0 <= anchor_idx < len(msgs)
+            and _message_hash(msgs[anchor_idx]) != state.anchor_hash
+        ):
+            state = _cache_window(session_id, WindowState())
+            anchor_idx = -history_offset
+            is_new_conversation = True
+
+        # Remember which message the window starts at, the first time we see it
+        if not state.anchor_hash and 0 <= anchor_idx < len(msgs):
+            state.anchor_hash = _message_hash(msgs[anchor_idx])
+
+        # If the caller left out messages we haven't seen yet, read them from the saved history,
+        # so they still get summarized instead of silently dropping out of the conversation
+        # (not for a new conversation: the saved history belongs to the old one)
+        seen_idx = state.window_start_idx + len(state.message_contents)
+        if history_offset > seen_idx and not is_new_conversation:
+            missing = await asyncio.to_thread(load_messages, session_id, seen_idx, history_offset)
+            if len(missing) == history_offset - seen_idx:
+                state.remember_new_messages(missing, seen_idx)
+
+        # Pick up the text of the messages added since last turn
+        state.remember_new_messages(msgs, history_offset)
+
+        # Only reset the window once it has grown past the token budget (or BUFFER_MAX messages)
+        # Until then we send the same prefix as last turn, plus the new messages
+        window_tokens = sum(state.message_tokens)
+        if window_tokens > MAX_CONTEXT_TOKENS or len(state.message_tokens) > BUFFER_MAX:
+            # Drop the oldest messages from the window until it's under half the budget
+            # and holds at most half of BUFFER_MAX messages
+            # We always keep the most recent messages (the last 3 messages)
+            # If they don't all fit in one summarizer prompt, _summarize cuts the text short
+            num_evicted = 0
+            evicted_tokens = 0
+            while (
+                window_tokens >= 0.5 * MAX_CONTEXT_TOKENS or len(state.message_tokens) - num_evicted > BUFFER_MAX // 2
+            ) and len(state.message_tokens) - num_evicted > SUMMARY_THRESHOLD:
+                window_tokens -= state.message_tokens[num_evicted]
+                evicted_tokens += state.message_tokens[num_evicted]
+                num_evicted += 1
+
+            # Only summarize when it actually frees up space: enough messages, or enough tokens
+            # If neither, almost all the tokens are in the recent messages we keep anyway,
+            # so we keep the window (and the old summary) exactly as it was
+            if num_evicted >= MIN_TO_SUMMARIZE or evicted_tokens >= MIN_TOKENS_SAVED:
+                # Take the text of the messages that are about to fall out of the window,
+                # minus filler and repeats, so the summarizer reads (and bills) fewer tokens
+                # Older ones are already part of the rolling summary, so we never re-read them
+                # islice walks the cached lists in place, so no copy of the evicted messages is made
+                evicted_contents = _prefilter(
+                    islice(state.message_contents, num_evicted),
+                    islice(state.message_types, num_evicted),
+                )
+
+                # Split what's left into chunks and combine each chunk into one text string
+                chunk_texts = [
+                    "\n".join(evicted_contents[start:start + CHUNK_SIZE])
+                    for start in range(0, len(evicted_contents), CHUNK_SIZE)
+                ]
+
+                # Ask the summarizer AI to merge all the chunks into the previous summary in one call
+                # One round-trip is much faster than one call per chunk plus a merge call
+                # If we've summarized this exact text before, the cached summary is reused
+                # If everything was filler, the old summary already says it all
+                # The cached counts of every evicted message (plus one token per newline and the separators)
+                # bound the text's size, so we don't have to tokenize it again
+                if chunk_texts:
+                    text_tokens = evicted_tokens + num_evicted + _SEPARATOR_TOKENS * len(chunk_texts)
+                    state.rolling_summary = await _summarize(
+                        CHUNK_SEPARATOR.join(chunk_texts), state.rolling_summary, text_tokens
+                    )
+
+                # Cache the summary message so the next turns reuse the exact same text
+                state.summary_cache = SystemMessage(content=f"[Summary] {state.rolling_summary}")
+
+                # Move the window forward and forget the evicted messages' text
+                state.window_start_idx += num_evicted
+                anchor_idx = state.window_start_idx - history_offset
+                state.anchor_hash = _message_hash(msgs[anchor_idx]) if anchor_idx >= 0 else ""
+                del state.message_contents[:num_evicted]
+                del state.message_tokens[:num_evicted]
+                del state.message_types[:num_evicted]
+
+                # Save the new summary so a restarted session can pick up right here
+                await asyncio.to_thread(_save_window, session_id, state)
+
+    return state
+
+
+async def precompute_summary(session_id: str, msgs, history_offset: int = 0) -> None:
+    """
+    Update the window in the background while the user is typing,
+    so the next model call usually finds the summary ready and skips the summarizer round-trip.
+    """
+    try:
+        await _advance_window(session_id, msgs, history_offset)
+    except Exception as e:
+        # Not fatal: the middleware will just try again on the next turn
+        print(f"Background summary failed: {e}")
+
 
 @wrap_model_call
-def summary_middleware(
+async def summary_middleware(
     request: ModelRequest,
-    handler: Callable[[ModelRequest], ModelResponse],
+    handler: Callable[[ModelRequest], Awaitable[ModelResponse]],
 ) -> ModelResponse:
     """
     Middleware that compresses old messages using an LLM summarizer.
     Calls a separate summarizer model to preserve context, then passes compressed messages to agent.
+    It's async so one conversation waiting on the summarizer doesn't block the others.
     """
     
     # Get all messages from the request
-    msgs = list(request.messages) or []
+    # We only read and slice them, so there's no need to copy the list
+    msgs = request.messages or ()
     
     # If there are no messages, just pass the request through without changes
     if not msgs:
-        return handler(request)
+        return await handler(request)
     
-    # This list will hold any summary messages we create
-    compressed = []
-
-    # Check if we have too many messages (more than our threshold)
-    if len(msgs) > SUMMARY_THRESHOLD:
-        # Keep only the most recent messages (the last 3 messages)
-        # These are the most important for the current conversation
-        messages_to_keep = msgs[-SUMMARY_THRESHOLD:]
-
-        # Get all the old messages that came before the recent ones
-        # These are the ones we want to summarize
-        messages_to_summarize = msgs[:-SUMMARY_THRESHOLD]
-        
-        # Combine all the old messages into one text string
-        # This makes it easier to send to the summarizer
-        chunk_text = "\n".join(getattr(m, "content", str(m)) for m in messages_to_summarize)
-        
-        # Ask the summarizer AI to create a short summary of all the old messages
-        summary_response = summarizer.invoke([
-            HumanMessage(content=f"Summarize this conversation briefly in 1-2 sentences:\n{chunk_text}")
-        ])
-        summary_text = summary_response.content
-        
-        # Create a system message with the summary and add it to our compressed list
-        compressed.append(SystemMessage(content=f"[Summary] {summary_text}"))
-        
-        # Replace the old messages with just the recent ones we're keeping
-        msgs = messages_to_keep
+    # Look up this conversation's window and bring it up to date
+    # Without a thread id we can't tell conversations apart, so we leave the messages alone
+    configurable = get_config().get("configurable", {})
+    session_id = configurable.get("thread_id")
+    if session_id is None:
+        return await handler(request)
+
+    # The caller may leave out older messages that the saved summary already covers
+    # msgs[0] is then message number history_offset of the whole conversation
+    history_offset = configurable.get("history_offset", 0)
+
+    # If the CLI already summarized in the background while the user was typing,
+    # this finds the window up to date and doesn't call the summarizer at all
+    try:
+        state = await _advance_window(session_id, msgs, history_offset)
+    except Exception as e:
+        # A failed summarizer call shouldn't cost the user their answer
+        print(f"Summary failed: {e}; sending original messages.")
+        return await handler(request)
 
-    # Build the final message list: summary (if any) + recent messages
+    # This list will hold the summary message (if we have one)
+    compressed = [state.summary_cache] if state.summary_cache is not None else []
+
+    # Build the final message list: summary (if any) + every message in the window
     # This way the agent gets context without too many old messages
-    new_messages = compressed + msgs
+    new_messages = [*compressed, *msgs[max(0, state.window_start_idx - history_offset):]]
 
     # Send the compressed messages to the actual agent
     try:
-        return handler(request.override(messages=new_messages))
+        return await handler(request.override(messages=new_messages))
     except Exception as e:
-        # If something goes wrong, print the error
-        # Note: The code should probably return handler(request) here to retry with original messages
+        # If something goes wrong, retry once with the original (uncompressed) messages
+        # so the agent still gets a real response instead of None
         print(f"Error: {e}; retrying with original messages.")
-        
-# Create an AI agent that uses our summary middleware
-# The middleware will automatically compress old messages before the agent sees them
-agent = create_agent(
-    model="gpt-4o-mini",
-    middleware=[summary_middleware],
-    # middleware=[
-    #     SummarizationMiddleware(
-    #         model="gpt-4o-mini",
-    #         trigger=("tokens", 30),
-    #         keep=("messages", 3),
-    #     ),
-    # ],
-)
+        return await handler(request)
 
-if __name__ == "__main__":
-    # This list stores the entire conversation history
-    messages = []
+
+@cache
+def get_agent():
+    """
+    Create an AI agent that uses our summary middleware.
+    The middleware will automatically compress old messages before the agent sees them.
+    Like the summarizer, the agent is built once on first use and then reused.
+    """
+    return create_agent(
+        model="gpt-4o-mini",
+        middleware=[summary_middleware],
+        # middleware=[
+        #     SummarizationMiddleware(
+        #         model="gpt-4o-mini",
+        #         trigger=("tokens", 30),
+        #         keep=("messages", 3),
+        #     ),
+        # ],
+    )
+
+
+async def main():
+    """Interactive CLI loop that chats with the agent until the user types 'quit'."""
+    # Every turn of this CLI session shares one message window in the middleware
+    # Run with the same SUMMARY_AGENT_SESSION again to pick up where you left off
+    session_id = os.getenv("SUMMARY_AGENT_SESSION", "cli")
+
+    # Messages before the window are already covered by the saved summary,
+    # so we only load the ones after it instead of re-summarizing everything
+    history_offset = get_window(session_id).window_start_idx
+    saved_messages = load_messages(session_id, history_offset)
+
+    # How many messages this conversation has had in total (including ones no longer in memory)
+    total_messages = history_offset + len(saved_messages)
+
+    # This deque stores the conversation history from the start of the summary window on
+    # Messages leave it only once the rolling summary has absorbed them, and the window
+    # itself is capped at BUFFER_MAX messages, so memory stays bounded
+    # Every new message is also saved to HISTORY_DB as soon as it's added
+    messages = deque(saved_messages)
     turn = 0
 
     print("=" * 60)
@@ -99,11 +588,18 @@ if __name__ == "__main__":
     print("=" * 60)
     print("Type 'quit' to exit.\n")
 
+    if messages:
+        print(f"📂 Resumed session '{session_id}' with {len(messages)} saved messages.\n")
+
+    # Background task that updates the summary while the user is typing
+    precompute = None
+
     # Main conversation loop - keeps running until user types 'quit'
     while True:
         turn += 1
         # Ask the user for input
-        user_input = input(f"[Turn {turn}] You: ").strip()
+        # input() runs in a thread so the background summary keeps going while we wait
+        user_input = (await asyncio.to_thread(input, f"[Turn {turn}] You: ")).strip()
 
         # Check if user wants to exit
         if user_input.lower() == "quit":
@@ -116,6 +612,17 @@ if __name__ == "__main__":
 
         # Add the user's message to our conversation history
         messages.append(HumanMessage(content=user_input))
+        save_message(session_id, total_messages, messages[-1])
+        total_messages += 1
+
+        # Forget messages the rolling summary has already absorbed, we don't need them in memory
+        window_start_idx = get_window(session_id).window_start_idx
+        while total_messages - len(messages) < window_start_idx:
+            messages.popleft()
+
+        # Tell the middleware where messages[0] sits in the whole conversation
+        history_offset = total_messages - len(messages)
+        config = {"configurable": {"thread_id": session_id, "history_offset": history_offset}}
         
         # Show how many messages we have before calling the agent
         print(f"\n📊 Message count before agent call: {len(messages)}")
@@ -123,25 +630,42 @@ if __name__ == "__main__":
         try:
             # Send all messages to the agent
             # The middleware will automatically compress old messages if needed
-            response = agent.invoke({"messages": messages})
+            # The middleware is async, so the agent has to be called with ainvoke
+            # The agent wants a list, so we copy the deque once here
+            response = await get_agent().ainvoke({"messages": list(messages)}, config=config)
 
             # Get the agent's response (the last message in the response)
             agent_response = response["messages"][-1].content
             
             # Add the agent's response to our conversation history
             messages.append(AIMessage(content=agent_response))
+            save_message(session_id, total_messages, messages[-1])
+            total_messages += 1
             
             # Show the agent's response and current message count
             print(f"\n🤖 Agent: {agent_response}\n")
             print(f"📊 Message count after agent call: {len(messages)}\n")
 
+            # Start summarizing the new history now, while the user thinks about their next message
+            precompute = asyncio.create_task(precompute_summary(
+                session_id, list(messages), total_messages - len(messages)
+            ))
+
         except Exception as e:
             # If something goes wrong, show the error
             print(f"❌ Error: {e}\n")
 
+    # Let a running background summary finish so it gets saved for next time
+    if precompute is not None:
+        await precompute
+
     print("\nTest completed.")
 
 
+if __name__ == "__main__":
+    asyncio.run(main())
+
+
 # Summary Middleware Agent
 # - My name is Ali, I play cricket everyday in morning 
 # - I am kinda jolly boy and loves cracking jokes 